@@ -2,6 +2,7 @@
 , buildPythonApplication
 , aiohttp
 , jsonschema
+, orjson
 , systemd
 , black
 , flake8
@@ -17,6 +18,7 @@ buildPythonApplication {
   propagatedBuildInputs = [
     aiohttp
     jsonschema
+    orjson
     systemd
   ];
 
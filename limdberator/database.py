@@ -18,69 +18,179 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
 import asyncio
+import concurrent.futures
+import logging
+import queue
 import sqlite3
-from types import TracebackType
-from typing import Iterator, List, Mapping, Optional, Sequence, Tuple, Type, Union
+import threading
+from collections import defaultdict
+from typing import (
+    Any,
+    Callable,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Union,
+)
 
 from .types import ScrapedPerson, ScrapedTitle
 
+logger = logging.getLogger(__name__)
+
+# maximum number of submissions committed in a single transaction
+MAX_BATCH_SIZE = 64
+
+Job = Callable[[sqlite3.Cursor], None]
+Submission = Tuple[Job, "concurrent.futures.Future[None]"]
+
+
+def fail_future(future: "concurrent.futures.Future[None]", exc: Exception) -> None:
+    """Set exc on future unless it has been resolved or cancelled already."""
+
+    try:
+        future.set_exception(exc)
+    except concurrent.futures.InvalidStateError:
+        pass
+
 
 class SharedConnection:
+    """Run all work on the connection in a dedicated writer thread. Work that
+    is submitted while a transaction is running is committed together in the
+    next transaction, so that concurrent scrapes share the cost of a commit.
+    Submitted jobs should only execute statements, everything else should be
+    prepared beforehand so the writer thread is not held up by it.
+    """
+
     def __init__(self, conn: sqlite3.Connection):
         self.conn = conn
-        self.lock = asyncio.Lock()
-        self.cursor = None  # type: Optional[sqlite3.Cursor]
         self.conn.isolation_level = None
-
-    async def __aenter__(self) -> sqlite3.Cursor:
-        """Lock the connection, return a cursor, and create a transaction."""
-
-        await self.lock.acquire()
-        try:
-            self.cursor = self.conn.cursor()
-            self.cursor.execute("BEGIN")
-            return self.cursor
-        except Exception:
-            self.cursor = None
-            self.lock.release()
-            raise
-
-    async def __aexit__(
-        self,
-        exc_type: Optional[Type[BaseException]],
-        exc: Optional[BaseException],
-        tb: Optional[TracebackType],
-    ) -> None:
-        try:
-            assert self.cursor is not None
+        self.queue = queue.Queue()  # type: queue.Queue[Optional[Submission]]
+        self.thread = threading.Thread(target=self.run, name="limdberator-writer")
+        self.thread.start()
+
+    async def submit(self, job: Job) -> None:
+        """Run job with a cursor in its own savepoint and wait until the
+        transaction it was run in is committed.
+        """
+
+        future = concurrent.futures.Future()  # type: concurrent.futures.Future[None]
+        self.queue.put((job, future))
+        await asyncio.wrap_future(future)
+
+    def close(self) -> None:
+        """Finish the submitted work and stop the writer thread."""
+
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self) -> None:
+        cursor = self.conn.cursor()
+        running = True
+        while running:
+            batch = []  # type: List[Submission]
+            item = self.queue.get()
+            while True:
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+                if len(batch) >= MAX_BATCH_SIZE:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            if not batch:
+                continue
             try:
-                if exc_type is not None:
-                    raise Exception
-                self.cursor.execute("COMMIT")
-            except Exception:
-                self.cursor.execute("ROLLBACK")
-        finally:
-            self.cursor = None
-            self.lock.release()
+                self.run_batch(cursor, batch)
+            except Exception as e:
+                # The writer thread must not die, otherwise every submission
+                # would wait forever.
+                logger.exception("writing a batch failed")
+                for _, future in batch:
+                    fail_future(future, e)
+
+    def run_batch(self, cursor: sqlite3.Cursor, batch: Sequence[Submission]) -> None:
+        done = []  # type: List[concurrent.futures.Future[None]]
+        try:
+            # Take the write lock right away. A deferred transaction that has to
+            # upgrade its read lock fails with SQLITE_BUSY without waiting if
+            # another connection is writing, an immediate one waits for it.
+            cursor.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                # a failing job must not take the others with it
+                cursor.execute("SAVEPOINT job")
+                try:
+                    job(cursor)
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO job")
+                    cursor.execute("RELEASE job")
+                    future.set_exception(e)
+                else:
+                    cursor.execute("RELEASE job")
+                    done.append(future)
+            cursor.execute("COMMIT")
+        except Exception as e:
+            if self.conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            for _, future in batch:
+                fail_future(future, e)
+        else:
+            for future in done:
+                future.set_result(None)
+
+
+# INSERT ... RETURNING needs SQLite 3.35, UPSERT and row values are older
+MIN_SQLITE_VERSION = (3, 35, 0)
 
 
 def init_database(cursor: sqlite3.Cursor) -> None:
+    if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+        raise RuntimeError(
+            "SQLite {} or later is required, found {}".format(
+                ".".join(map(str, MIN_SQLITE_VERSION)), sqlite3.sqlite_version
+            )
+        )
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS scrapes ("
         "id INTEGER PRIMARY KEY, "
         "timestamp INTEGER NOT NULL"
         ")"
     )
-    cursor.execute("CREATE TABLE IF NOT EXISTS _changes (id INTEGER PRIMARY KEY)")
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS changes ("
-        "id INTEGER NOT NULL REFERENCES _changes(id), "
+        "id INTEGER NOT NULL, "
         "scrape_id INTEGER NOT NULL REFERENCES scrapes(id)"
         ")"
     )
+    # nothing looks up changes by scrape, so the index only slowed down writes
+    cursor.execute("DROP INDEX IF EXISTS idx_changes_scrape")
+    unique_index = cursor.execute(
+        "SELECT name FROM sqlite_master "
+        "WHERE type='index' AND name='idx_changes_unique'"
+    ).fetchone()
+    if unique_index is None:
+        # databases created before the index may contain duplicates
+        cursor.execute(
+            "DELETE FROM changes WHERE rowid NOT IN "
+            "(SELECT MIN(rowid) FROM changes GROUP BY id, scrape_id)"
+        )
+        cursor.execute(
+            "CREATE UNIQUE INDEX idx_changes_unique ON changes (id, scrape_id)"
+        )
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS title_info ("
-        "change_id INTEGER PRIMARY KEY REFERENCES _changes(id), "
+        "change_id INTEGER PRIMARY KEY, "
         "title_id TEXT NOT NULL, "
         "key TEXT NOT NULL, "
         "value BLOB NOT NULL, "
@@ -89,7 +199,7 @@ def init_database(cursor: sqlite3.Cursor) -> None:
     )
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS title_tags ("
-        "change_id INTEGER PRIMARY KEY REFERENCES _changes(id), "
+        "change_id INTEGER PRIMARY KEY, "
         "title_id TEXT NOT NULL, "
         "tag TEXT, "
         "UNIQUE(title_id, tag)"
@@ -97,7 +207,7 @@ def init_database(cursor: sqlite3.Cursor) -> None:
     )
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS people_info ("
-        "change_id INTEGER PRIMARY KEY REFERENCES _changes(id), "
+        "change_id INTEGER PRIMARY KEY, "
         "person_id TEXT NOT NULL, "
         "key TEXT NOT NULL, "
         "value BLOB NOT NULL, "
@@ -106,7 +216,7 @@ def init_database(cursor: sqlite3.Cursor) -> None:
     )
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS credits ("
-        "change_id INTEGER PRIMARY KEY REFERENCES _changes(id), "
+        "change_id INTEGER PRIMARY KEY, "
         "title_id TEXT NOT NULL, "
         "credit_type TEXT, "
         "person_id TEXT NOT NULL, "
@@ -115,13 +225,20 @@ def init_database(cursor: sqlite3.Cursor) -> None:
     )
     cursor.execute(
         "CREATE TABLE IF NOT EXISTS credit_tags ("
-        "change_id INTEGER PRIMARY KEY REFERENCES _changes(id), "
+        "change_id INTEGER PRIMARY KEY, "
         "title_id TEXT NOT NULL, "
         "person_id TEXT NOT NULL, "
         "tag TEXT, "
         "UNIQUE(title_id, person_id, tag)"
         ")"
     )
+    # The change_id columns are aliases for the rowid, which is part of every
+    # index, so the indexes created for the UNIQUE constraints already cover
+    # all lookups of change_ids. Only sample about 400 rows per index, so that
+    # collecting statistics on every start does not take longer the larger the
+    # database gets.
+    cursor.execute("PRAGMA analysis_limit=400")
+    cursor.execute("ANALYZE")
 
 
 def insert_new_scrape(cursor: sqlite3.Cursor, timestamp: int) -> int:
@@ -129,57 +246,144 @@ def insert_new_scrape(cursor: sqlite3.Cursor, timestamp: int) -> int:
     return cursor.lastrowid
 
 
-def insert_new_change(cursor: sqlite3.Cursor, scrape_id: int) -> int:
-    cursor.execute("INSERT INTO _changes (id) VALUES (?)", (None,))
-    change_id = cursor.lastrowid
-    cursor.execute(
-        "INSERT INTO changes (id, scrape_id) VALUES (?, ?)", (change_id, scrape_id)
+# columns of each table's UNIQUE constraint, rows are passed in this order
+TABLE_COLUMNS = {
+    "title_info": ("title_id", "key", "value"),
+    "title_tags": ("title_id", "tag"),
+    "people_info": ("person_id", "key", "value"),
+    "credits": ("title_id", "credit_type", "person_id"),
+    "credit_tags": ("title_id", "person_id", "tag"),
+}
+
+# change_ids are unique across all tables in TABLE_COLUMNS and are their rowids,
+# so the highest change_id can be found without scanning any table
+LAST_CHANGE_ID_SQL = "SELECT COALESCE(MAX(id), 0) FROM ({})".format(
+    " UNION ALL ".join(
+        f"SELECT MAX(change_id) AS id FROM {table}" for table in TABLE_COLUMNS
+    )
+)
+
+# maximum number of rows passed to a single statement, must be a power of two
+# and small enough to stay below SQLite's default limit of 999 parameters
+MAX_CHUNK_SIZE = 128
+
+Row = Tuple[Union[None, int, str], ...]
+Args = List[Union[None, int, str]]
+
+
+def build_insert_sql(table: str, cols: Sequence[str], n: int) -> str:
+    placeholder = f"({', '.join('?' * (len(cols) + 1))})"
+    return (
+        f"INSERT INTO {table} ({', '.join(cols)}, change_id) "
+        f"VALUES {', '.join([placeholder] * n)} "
+        f"ON CONFLICT ({', '.join(cols)}) DO NOTHING "
+        f"RETURNING change_id, {', '.join(cols)}"
+    )
+
+
+def build_select_sql(table: str, cols: Sequence[str], n: int) -> str:
+    placeholder = f"({', '.join('?' * len(cols))})"
+    return (
+        f"SELECT change_id, {', '.join(cols)} FROM {table} "
+        f"WHERE ({', '.join(cols)}) IN (VALUES {', '.join([placeholder] * n)})"
     )
-    return change_id
 
 
-def insert_with_change(
-    cursor: sqlite3.Cursor,
-    scrape_id: int,
-    table: str,
-    row: Mapping[str, Union[None, int, str]],
+def execute_chunked(
+    cursor: sqlite3.Cursor, statements: Mapping[int, str], args: Args, width: int
+) -> Iterator[Tuple[Any, ...]]:
+    """Execute statements[n] for consecutive chunks of n rows, each consisting
+    of width args, and yield the resulting rows. n is always a power of two.
+    """
+
+    remaining = len(args) // width
+    start = 0
+    while remaining:
+        n = 1 << (min(remaining, MAX_CHUNK_SIZE).bit_length() - 1)
+        end = start + n * width
+        yield from cursor.execute(statements[n], args[start:end]).fetchall()
+        start = end
+        remaining -= n
+
+
+Upserter = Callable[[sqlite3.Cursor, Iterable[Row], int], Dict[Row, int]]
+
+
+def make_upserter(table: str, cols: Sequence[str]) -> Upserter:
+    """Return a function that inserts new rows into table and returns the
+    change_id of every distinct row. Rows equal to an existing one keep its
+    change_id, all others get a new change_id counting up from
+    first_change_id. The rows' values must be in the order of cols.
+    """
+
+    # only build statements for powers of two, so that few enough distinct
+    # statements are used to keep all of them in sqlite3's statement cache
+    sizes = [1 << i for i in range(MAX_CHUNK_SIZE.bit_length())]
+    insert_sql = {n: build_insert_sql(table, cols, n) for n in sizes}
+    select_sql = {n: build_select_sql(table, cols, n) for n in sizes}
+    width = len(cols)
+
+    def upsert_rows(
+        cursor: sqlite3.Cursor, rows: Iterable[Row], first_change_id: int
+    ) -> Dict[Row, int]:
+        distinct_rows = list(dict.fromkeys(rows))
+        args = []  # type: Args
+        for change_id, row in enumerate(distinct_rows, first_change_id):
+            args.extend(row)
+            args.append(change_id)
+        change_ids = {
+            tuple(row): change_id
+            for change_id, *row in execute_chunked(cursor, insert_sql, args, width + 1)
+        }  # type: Dict[Row, int]
+
+        # Rows that exist already are skipped by the INSERT and not returned.
+        # Look them up afterwards instead of updating them in place, so that
+        # they are not rewritten. When all rows are new this is skipped.
+        if len(change_ids) < len(distinct_rows):
+            args = []
+            for row in distinct_rows:
+                if row not in change_ids:
+                    args.extend(row)
+            for change_id, *existing_row in execute_chunked(
+                cursor, select_sql, args, width
+            ):
+                change_ids[tuple(existing_row)] = change_id
+        assert len(change_ids) == len(distinct_rows)
+        return change_ids
+
+    return upsert_rows
+
+
+UPSERTERS = {table: make_upserter(table, cols) for table, cols in TABLE_COLUMNS.items()}
+
+
+def insert_scrape(
+    cursor: sqlite3.Cursor, timestamp: int, rows: Mapping[str, Sequence[Row]]
 ) -> None:
-    """Insert a new row into table. If an equal row exists already, associate
-    its change_id with the current scrape_id, otherwise create and associate a
+    """Insert a new scrape and its rows. For every row equal to an existing one
+    associate its change_id with the scrape, otherwise create and associate a
     new change_id.
     """
 
-    cols = []  # type: List[str]
-    args = ()  # type: Tuple[Union[None, int, str], ...]
-    for col, val in row.items():
-        cols.append(col)
-        args += (val,)
-    assert cols
-
-    # equal row exists...
-    for (change_id,) in cursor.execute(
-        f"SELECT change_id FROM {table} WHERE {'=? AND '.join(cols)}=? LIMIT 1",
-        args,
-    ):
-        cursor.execute(
-            "INSERT INTO changes (id, scrape_id) VALUES (?, ?)",
-            (change_id, scrape_id),
-        )
-        return
-
-    # ...otherwise insert with a new change_id
-    change_id = insert_new_change(cursor, scrape_id)
-    cols.append("change_id")
-    args += (change_id,)
-    cursor.execute(
-        f"INSERT INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(args))})",
-        args,
+    scrape_id = insert_new_scrape(cursor, timestamp)
+
+    (last_change_id,) = cursor.execute(LAST_CHANGE_ID_SQL).fetchone()
+    next_change_id = last_change_id + 1
+    # a scrape may contain the same row more than once, e.g. a cast member
+    # listed twice, but it is only one change
+    change_ids = set()  # type: Set[int]
+    for table, table_rows in rows.items():
+        table_change_ids = UPSERTERS[table](cursor, table_rows, next_change_id)
+        change_ids.update(table_change_ids.values())
+        next_change_id += len(table_change_ids)
+
+    cursor.executemany(
+        "INSERT INTO changes (id, scrape_id) VALUES (?, ?)",
+        [(change_id, scrape_id) for change_id in sorted(change_ids)],
     )
 
 
-def gen_title_info_data(
-    scrape: ScrapedTitle,
-) -> Iterator[Mapping[str, Union[int, str]]]:
+def gen_title_info_data(scrape: ScrapedTitle) -> Iterator[Row]:
     """Generate rows to insert into title_info."""
 
     for key in (
@@ -191,111 +395,81 @@ def gen_title_info_data(
         "duration",
     ):
         if key in scrape:
-            yield {
-                "title_id": scrape["id"],
-                "key": key,
-                "value": scrape[key],  # type: ignore
-            }
+            yield (scrape["id"], key, scrape[key])  # type: ignore
     for lang in scrape.get("languages") or []:
-        yield {"title_id": scrape["id"], "key": "language", "value": lang}
+        yield (scrape["id"], "language", lang)
+
+
+def title_rows(scrape: ScrapedTitle) -> Mapping[str, Sequence[Row]]:
+    """Return the rows to insert for a scraped title per table."""
+
+    rows = defaultdict(list)  # type: DefaultDict[str, List[Row]]
+    rows["title_info"].extend(gen_title_info_data(scrape))
+    for person_id, name in scrape.get("cast") or []:
+        rows["people_info"].append((person_id, "name", name))
+        rows["credits"].append((scrape["id"], "actor", person_id))
+    return rows
+
+
+def person_rows(scrape: ScrapedPerson) -> Mapping[str, Sequence[Row]]:
+    """Return the rows to insert for a scraped person per table."""
+
+    person_id = scrape["id"]
+    people_info_rows = []  # type: List[Row]
+    credit_rows = []  # type: List[Row]
+    credit_tag_rows = []  # type: List[Row]
+    title_info_rows = []  # type: List[Row]
+    title_tag_rows = []  # type: List[Row]
+
+    for key in ("name", "birthday"):
+        if key in scrape:
+            people_info_rows.append((person_id, key, scrape[key]))  # type: ignore
+
+    for title_id, credit in (scrape.get("filmography") or {}).items():
+        # actual credit
+        credit_types = credit["credit_type"]  # type: Sequence[Optional[str]]
+        for credit_type in credit_types or [None]:
+            credit_rows.append((title_id, credit_type, person_id))
+
+        # credit tags
+        for tag in credit["tags"]:
+            credit_tag_rows.append((title_id, person_id, tag))
+
+        # title_info
+        title_info = credit["title_info"]
+        for key in ("title", "year"):
+            value = title_info.get(key)
+            if value is not None:
+                title_info_rows.append((title_id, key, value))  # type: ignore
+
+        # title tags
+        for tag in title_info["tags"]:
+            title_tag_rows.append((title_id, tag))
+
+    # insert one table after the other, so that each table's index pages stay
+    # hot and the same statements are reused
+    return {
+        "people_info": people_info_rows,
+        "credits": credit_rows,
+        "credit_tags": credit_tag_rows,
+        "title_info": title_info_rows,
+        "title_tags": title_tag_rows,
+    }
+
+
+async def store_scrape(
+    shared_conn: SharedConnection, timestamp: int, rows: Mapping[str, Sequence[Row]]
+) -> None:
+    await shared_conn.submit(lambda cursor: insert_scrape(cursor, timestamp, rows))
 
 
 async def store_scraped_title(
     shared_conn: SharedConnection, scrape: ScrapedTitle
 ) -> None:
-    async with shared_conn as cursor:
-        scrape_id = insert_new_scrape(cursor, scrape["timestamp"])
-        for row in gen_title_info_data(scrape):
-            insert_with_change(cursor, scrape_id, "title_info", row)
-        for person_id, name in scrape.get("cast") or []:
-            insert_with_change(
-                cursor,
-                scrape_id,
-                "people_info",
-                {
-                    "person_id": person_id,
-                    "key": "name",
-                    "value": name,
-                },
-            )
-            insert_with_change(
-                cursor,
-                scrape_id,
-                "credits",
-                {
-                    "title_id": scrape["id"],
-                    "credit_type": "actor",
-                    "person_id": person_id,
-                },
-            )
+    await store_scrape(shared_conn, scrape["timestamp"], title_rows(scrape))
 
 
 async def store_scraped_person(
     shared_conn: SharedConnection, scrape: ScrapedPerson
 ) -> None:
-    async with shared_conn as cursor:
-        scrape_id = insert_new_scrape(cursor, scrape["timestamp"])
-
-        for key in ("name", "birthday"):
-            if key in scrape:
-                insert_with_change(
-                    cursor,
-                    scrape_id,
-                    "people_info",
-                    {
-                        "person_id": scrape["id"],
-                        "key": key,
-                        "value": scrape[key],  # type: ignore
-                    },
-                )
-
-        for title_id, credit in (scrape.get("filmography") or {}).items():
-            # actual credit
-            credit_types = credit["credit_type"]  # type: Sequence[Optional[str]]
-            for credit_type in credit_types or [None]:
-                insert_with_change(
-                    cursor,
-                    scrape_id,
-                    "credits",
-                    {
-                        "title_id": title_id,
-                        "credit_type": credit_type,
-                        "person_id": scrape["id"],
-                    },
-                )
-
-            # credit tags
-            for tag in credit["tags"]:
-                insert_with_change(
-                    cursor,
-                    scrape_id,
-                    "credit_tags",
-                    {
-                        "title_id": title_id,
-                        "person_id": scrape["id"],
-                        "tag": tag,
-                    },
-                )
-
-            # title_info
-            title_info = {
-                "id": title_id,
-                "timestamp": -1,
-            }  # type: ScrapedTitle
-            for key in ("title", "year"):
-                if credit["title_info"].get(key) is not None:
-                    title_info[key] = credit["title_info"][key]  # type: ignore
-            for row in gen_title_info_data(title_info):
-                insert_with_change(cursor, scrape_id, "title_info", row)
-
-            # title tags
-            for tag in credit["title_info"]["tags"]:
-                insert_with_change(
-                    cursor,
-                    scrape_id,
-                    "title_tags",
-                    {
-                        "title_id": title_id,
-                        "tag": tag,
-                    },
-                )
+    await store_scrape(shared_conn, scrape["timestamp"], person_rows(scrape))
@@ -17,10 +17,14 @@ along with this program; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 
+import functools
 import typing  # _UnionGenericAlias
 from typing import List, Mapping, Tuple, TypedDict, Union
 
 
+# types used more than once (e.g. CastMember) share the same subschema, which
+# therefore must not be modified
+@functools.lru_cache(maxsize=None)
 def schema_from_typing(t):  # type: ignore
     if t == str:
         return {"type": "string"}
@@ -41,6 +41,11 @@ from .database import (
     store_scraped_title,
 )
 
+try:
+    from orjson import loads as json_loads  # type: ignore
+except ImportError:
+    from json import loads as json_loads  # type: ignore
+
 try:
     import systemd.daemon  # type: ignore
 except ImportError:
@@ -71,6 +76,11 @@ else:
 
 
 scrape_result_schema = schema_from_typing(ScrapeResult)  # type: ignore
+# jsonschema.validate() would check the schema and create a new validator on
+# every call, so do that only once
+ScrapeResultValidator = jsonschema.validators.validator_for(scrape_result_schema)
+ScrapeResultValidator.check_schema(scrape_result_schema)
+scrape_result_validator = ScrapeResultValidator(scrape_result_schema)
 
 
 def create_app(shared_conn: SharedConnection) -> web.Application:
@@ -78,12 +88,15 @@ def create_app(shared_conn: SharedConnection) -> web.Application:
 
     @routes.post("/")
     async def post(request: web.Request) -> web.Response:
-        data = await request.json()
-        try:
-            jsonschema.validate(data, scrape_result_schema)
-        except jsonschema.exceptions.ValidationError as e:
-            raise web.HTTPBadRequest(text="400 Bad Request\n\n" + e.message)
+        data = json_loads(await request.read())
+        error = jsonschema.exceptions.best_match(
+            scrape_result_validator.iter_errors(data)
+        )
+        if error is not None:
+            raise web.HTTPBadRequest(text="400 Bad Request\n\n" + error.message)
         scrape = cast(ScrapeResult, data)
+        # the schema does not forbid additional keys, so a valid result may
+        # contain both, the title takes precedence
         if "title" in scrape:
             await store_scraped_title(
                 shared_conn, cast(ScrapeResultTitle, scrape)["title"]
@@ -104,12 +117,13 @@ def create_app(shared_conn: SharedConnection) -> web.Application:
 ListenAddress = Union[str, Tuple[str, int], socket.socket]
 
 
+listen_address_re = re.compile(
+    r"^(?:(?P<socket>.*/.*)|(?:(?:\[(?P<ipv6>.*)\]|(?P<host>.*)):(?P<port>\d+)))$"
+)
+
+
 def listen_address(arg: str) -> ListenAddress:
-    socket = r"(?P<socket>.*/.*)"
-    ipv6 = r"\[(?P<ipv6>.*)\]"
-    host = r"(?P<host>.*)"
-    port = r":(?P<port>\d+)"
-    m = re.match(f"^(?:{socket}|(?:(?:{ipv6}|{host}){port}))$", arg)
+    m = listen_address_re.match(arg)
     if m is None:
         raise ValueError
     if m["port"]:
@@ -122,30 +136,42 @@ def listen_address(arg: str) -> ListenAddress:
 
 async def real_main(database: str, listen_addresses: List[ListenAddress]) -> None:
     assert listen_addresses
-    with sqlite3.connect(database) as conn:
+    with sqlite3.connect(
+        database, isolation_level=None, check_same_thread=False, cached_statements=256
+    ) as conn:
+        # with WAL and synchronous=NORMAL a commit does not have to wait for fsync
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA mmap_size=268435456")
         init_database(conn.cursor())
-        shared_conn = SharedConnection(conn)
 
-        app = create_app(shared_conn)
-        runner = AppRunner(app)
-        await runner.setup()
+        # the connection is only used by the writer thread from now on
+        shared_conn = SharedConnection(conn)
         try:
-            sites = []  # type: List[BaseSite]
-            for address in listen_addresses:
-                if isinstance(address, socket.socket):
-                    sites.append(SockSite(runner, address))
-                elif isinstance(address, str):
-                    sites.append(UnixSite(runner, address))
-                else:
-                    host, port = address
-                    sites.append(TCPSite(runner, host, port))
-            for site in sites:
-                await site.start()
-
-            while True:
-                await asyncio.sleep(3600)
+            app = create_app(shared_conn)
+            runner = AppRunner(app)
+            await runner.setup()
+            try:
+                sites = []  # type: List[BaseSite]
+                for address in listen_addresses:
+                    if isinstance(address, socket.socket):
+                        sites.append(SockSite(runner, address))
+                    elif isinstance(address, str):
+                        sites.append(UnixSite(runner, address))
+                    else:
+                        host, port = address
+                        sites.append(TCPSite(runner, host, port))
+                for site in sites:
+                    await site.start()
+
+                while True:
+                    await asyncio.sleep(3600)
+            finally:
+                await runner.cleanup()
         finally:
-            await runner.cleanup()
+            shared_conn.close()
 
 
 def main(argv: Optional[List[str]] = None) -> None:
@@ -0,0 +1,292 @@
+"""
+limdberator
+Copyright (C) 2022  schnusch
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import asyncio
+import sqlite3
+import threading
+import unittest
+from typing import Dict, List, Mapping, Tuple
+from unittest import mock
+
+from limdberator.database import (
+    TABLE_COLUMNS,
+    Job,
+    Row,
+    SharedConnection,
+    init_database,
+    insert_scrape,
+)
+
+# schema of databases created before the unique index on changes existed
+OLD_SCHEMA = """
+CREATE TABLE scrapes (id INTEGER PRIMARY KEY, timestamp INTEGER NOT NULL);
+CREATE TABLE _changes (id INTEGER PRIMARY KEY);
+CREATE TABLE changes (
+    id INTEGER NOT NULL REFERENCES _changes(id),
+    scrape_id INTEGER NOT NULL REFERENCES scrapes(id)
+);
+CREATE TABLE title_info (
+    change_id INTEGER PRIMARY KEY REFERENCES _changes(id),
+    title_id TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    UNIQUE(title_id, key, value)
+);
+"""
+
+
+class InitDatabase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.conn = sqlite3.connect(":memory:", isolation_level=None)
+        self.addCleanup(self.conn.close)
+
+    def test_remove_duplicate_changes(self) -> None:
+        self.conn.executescript(OLD_SCHEMA)
+        self.conn.executemany(
+            "INSERT INTO scrapes (id, timestamp) VALUES (?, ?)", [(1, 10), (2, 20)]
+        )
+        self.conn.executemany("INSERT INTO _changes (id) VALUES (?)", [(1,), (2,)])
+        self.conn.executemany(
+            "INSERT INTO title_info (change_id, title_id, key, value) "
+            "VALUES (?, ?, ?, ?)",
+            [(1, "tt1", "title", "Foo"), (2, "tt1", "year", "1999")],
+        )
+        self.conn.executemany(
+            "INSERT INTO changes (id, scrape_id) VALUES (?, ?)",
+            [(1, 1), (1, 1), (2, 1), (1, 2), (2, 2), (2, 2), (2, 2)],
+        )
+
+        init_database(self.conn.cursor())
+        self.assertEqual(
+            self.conn.execute(
+                "SELECT id, scrape_id FROM changes ORDER BY id, scrape_id"
+            ).fetchall(),
+            [(1, 1), (1, 2), (2, 1), (2, 2)],
+        )
+        self.assertEqual(
+            self.conn.execute(
+                "SELECT change_id, title_id, key, value FROM title_info "
+                "ORDER BY change_id"
+            ).fetchall(),
+            [(1, "tt1", "title", "Foo"), (2, "tt1", "year", "1999")],
+        )
+        self.assertIsNotNone(
+            self.conn.execute(
+                "SELECT name FROM sqlite_master "
+                "WHERE type='index' AND name='idx_changes_unique'"
+            ).fetchone()
+        )
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.conn.execute("INSERT INTO changes (id, scrape_id) VALUES (1, 1)")
+
+        # the second run must not touch changes again
+        statements = []  # type: List[str]
+        self.conn.set_trace_callback(statements.append)
+        init_database(self.conn.cursor())
+        self.conn.set_trace_callback(None)
+        self.assertFalse(
+            [s for s in statements if s.startswith(("DELETE", "CREATE UNIQUE"))]
+        )
+        self.assertEqual(
+            self.conn.execute("SELECT COUNT(*) FROM changes").fetchone(), (4,)
+        )
+
+    def test_old_sqlite(self) -> None:
+        with mock.patch.object(sqlite3, "sqlite_version_info", (3, 34, 1)):
+            with self.assertRaises(RuntimeError):
+                init_database(self.conn.cursor())
+        self.assertIsNone(
+            self.conn.execute("SELECT name FROM sqlite_master").fetchone()
+        )
+
+
+def scrape_rows(start: int, stop: int) -> Mapping[str, List[Row]]:
+    rows = {
+        "title_info": [(f"tt{i}", "title", f"Title {i}") for i in range(start, stop)],
+        "title_tags": [(f"tt{i}", "tag") for i in range(start, stop)],
+        "people_info": [(f"nm{i}", "name", f"Name {i}") for i in range(start, stop)],
+        "credits": [
+            (f"tt{i}", "actor" if i % 2 else None, f"nm{i}") for i in range(start, stop)
+        ],
+        "credit_tags": [(f"tt{i}", f"nm{i}", "tag") for i in range(start, stop)],
+    }  # type: Dict[str, List[Row]]
+    # a scrape may contain the same row more than once
+    for table_rows in rows.values():
+        table_rows.extend(table_rows[:10])
+    return rows
+
+
+class InsertScrape(unittest.TestCase):
+    def setUp(self) -> None:
+        self.conn = sqlite3.connect(":memory:", isolation_level=None)
+        self.addCleanup(self.conn.close)
+        init_database(self.conn.cursor())
+
+    def table_rows(self, table: str) -> List[Tuple[int, Row]]:
+        return [
+            (change_id, tuple(row))
+            for change_id, *row in self.conn.execute(
+                f"SELECT change_id, {', '.join(TABLE_COLUMNS[table])} FROM {table} "
+                "ORDER BY change_id"
+            )
+        ]
+
+    def test_insert_scrape(self) -> None:
+        # more than MAX_CHUNK_SIZE rows per table, half of the second scrape's
+        # rows exist already
+        first_rows = scrape_rows(0, 200)
+        second_rows = scrape_rows(100, 300)
+
+        insert_scrape(self.conn.cursor(), 10, first_rows)
+        first_change_ids = {}  # type: Dict[str, Dict[Row, int]]
+        for table in TABLE_COLUMNS:
+            table_rows = self.table_rows(table)
+            self.assertEqual(len(table_rows), 200)
+            first_change_ids[table] = {row: change_id for change_id, row in table_rows}
+
+        insert_scrape(self.conn.cursor(), 20, second_rows)
+        all_change_ids = []  # type: List[int]
+        expected_changes = []  # type: List[Tuple[int, int]]
+        for table in TABLE_COLUMNS:
+            table_rows = self.table_rows(table)
+            all_change_ids.extend(change_id for change_id, _ in table_rows)
+            # for rows stored more than once keep the latest change_id
+            latest_change_ids = {row: change_id for change_id, row in table_rows}
+
+            for row, change_id in first_change_ids[table].items():
+                if row in second_rows[table] and None not in row:
+                    self.assertEqual(latest_change_ids[row], change_id)
+            expected_changes.extend(
+                (change_id, 1) for change_id in first_change_ids[table].values()
+            )
+            expected_changes.extend(
+                (latest_change_ids[row], 2) for row in set(second_rows[table])
+            )
+
+            if table == "credits":
+                # UNIQUE treats NULLs as distinct, so a row with a NULL is never
+                # equal to an existing one and is stored again
+                self.assertEqual(len(table_rows), 350)
+                self.assertEqual(
+                    [row for _, row in table_rows].count(("tt100", None, "nm100")),
+                    2,
+                )
+            else:
+                self.assertEqual(len(table_rows), 300)
+
+        # change_ids are unique across all tables
+        self.assertEqual(len(all_change_ids), len(set(all_change_ids)))
+        self.assertEqual(
+            self.conn.execute(
+                "SELECT id, scrape_id FROM changes ORDER BY id, scrape_id"
+            ).fetchall(),
+            sorted(expected_changes),
+        )
+
+
+class SharedConnectionTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.conn = sqlite3.connect(
+            ":memory:", isolation_level=None, check_same_thread=False
+        )
+        self.addCleanup(self.conn.close)
+        self.conn.execute("CREATE TABLE t (x INTEGER)")
+        self.shared_conn = SharedConnection(self.conn)
+        self.addCleanup(self.shared_conn.close)
+
+    def values(self) -> List[int]:
+        return [x for (x,) in self.conn.execute("SELECT x FROM t ORDER BY x")]
+
+    @staticmethod
+    def insert(x: int) -> Job:
+        def job(cursor: sqlite3.Cursor) -> None:
+            cursor.execute("INSERT INTO t (x) VALUES (?)", (x,))
+
+        return job
+
+    async def test_failing_job(self) -> None:
+        def fail(cursor: sqlite3.Cursor) -> None:
+            cursor.execute("INSERT INTO t (x) VALUES (2)")
+            raise ValueError("fail")
+
+        # block the writer thread, so that all jobs end up in the same batch
+        started = threading.Event()
+        release = threading.Event()
+
+        def block(cursor: sqlite3.Cursor) -> None:
+            started.set()
+            release.wait()
+
+        blocker = asyncio.ensure_future(self.shared_conn.submit(block))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        jobs = [
+            asyncio.ensure_future(self.shared_conn.submit(job))
+            for job in (self.insert(1), fail, self.insert(3))
+        ]
+        await asyncio.sleep(0)
+        release.set()
+        await blocker
+
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsNone(results[2])
+        self.assertEqual(self.values(), [1, 3])
+
+    async def test_cancelled_job(self) -> None:
+        started = threading.Event()
+        release = threading.Event()
+
+        def block(cursor: sqlite3.Cursor) -> None:
+            started.set()
+            release.wait()
+
+        blocker = asyncio.ensure_future(self.shared_conn.submit(block))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        cancelled = asyncio.ensure_future(self.shared_conn.submit(self.insert(1)))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await cancelled
+        release.set()
+        await blocker
+
+        await self.shared_conn.submit(self.insert(2))
+        self.assertEqual(self.values(), [2])
+
+    async def test_broken_transaction(self) -> None:
+        # ending the transaction makes releasing the job's savepoint fail
+        def rollback(cursor: sqlite3.Cursor) -> None:
+            cursor.execute("ROLLBACK")
+
+        with self.assertRaises(sqlite3.OperationalError):
+            await self.shared_conn.submit(rollback)
+        await self.shared_conn.submit(self.insert(1))
+        self.assertEqual(self.values(), [1])
+
+    async def test_writer_survives(self) -> None:
+        with mock.patch.object(
+            self.shared_conn, "run_batch", side_effect=RuntimeError("broken")
+        ):
+            with self.assertLogs("limdberator.database"):
+                with self.assertRaises(RuntimeError):
+                    await self.shared_conn.submit(self.insert(1))
+        await self.shared_conn.submit(self.insert(2))
+        self.assertEqual(self.values(), [2])
+        self.assertTrue(self.shared_conn.thread.is_alive())
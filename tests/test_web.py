@@ -0,0 +1,54 @@
+"""
+limdberator
+Copyright (C) 2022  schnusch
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+
+import sqlite3
+import unittest
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from limdberator.database import SharedConnection, init_database
+from limdberator.web import create_app
+
+
+class Post(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.conn = sqlite3.connect(
+            ":memory:", isolation_level=None, check_same_thread=False
+        )
+        self.addCleanup(self.conn.close)
+        init_database(self.conn.cursor())
+        shared_conn = SharedConnection(self.conn)
+        self.addCleanup(shared_conn.close)
+        self.client = TestClient(TestServer(create_app(shared_conn)))
+        await self.client.start_server()
+        self.addAsyncCleanup(self.client.close)
+
+    async def test_additional_keys(self) -> None:
+        # the person is invalid, so this only matches the title schema
+        resp = await self.client.post(
+            "/", json={"title": {"id": "tt1", "timestamp": 1}, "person": {"id": 5}}
+        )
+        self.assertEqual(resp.status, 204)
+        self.assertEqual(
+            self.conn.execute("SELECT timestamp FROM scrapes").fetchall(), [(1,)]
+        )
+
+    async def test_invalid(self) -> None:
+        resp = await self.client.post("/", json={"person": {"id": 5}})
+        self.assertEqual(resp.status, 400)